@@ -69,6 +69,7 @@ def test_e2e(model_type):
         server.logprob(samples)
         samples = server.sample(100, evidence)
         server.logprob(samples)
+        server.logprob(samples, evidence)
         try:
             median = server.median([evidence])
             server.logprob(median)
@@ -26,7 +26,9 @@ from treecat.structure import estimate_tree
 from treecat.structure import make_propagation_program
 from treecat.structure import sample_tree
 from treecat.util import TODO
+from treecat.util import default_rng
 from treecat.util import guess_counts
+from treecat.util import jit
 from treecat.util import profile
 from treecat.util import quantize_from_probs2
 from treecat.util import sample_from_probs2
@@ -163,6 +165,51 @@ class ServerBase(object):
         """Compute correlation matrix among latent features."""
 
 
+@profile
+@jit(nopython=True, cache=True)
+def treecat_logprob(
+        program,
+        ragged_index,
+        data,
+        vert_probs,
+        edge_trans,
+        feat_cond, ):
+    N = data.shape[0]
+    V, M = vert_probs.shape
+    messages = np.empty((V, M, N), np.float32)
+    for v in range(V):
+        for m in range(M):
+            messages[v, m, :] = vert_probs[v, m]
+    logprob = np.zeros(N, np.float32)
+
+    for i in range(len(program)):
+        op, v, v2, e = program[i]
+        message = messages[v, :, :]
+        if op == OP_UP:
+            # Propagate upward from observed to latent.
+            beg, end = ragged_index[v:v + 2]
+            for r in range(beg, end):
+                # This uses a with-replacement approximation that is exact
+                # for categorical data but approximate for multinomial.
+                for n in range(N):
+                    power = data[n, r]
+                    if power:
+                        for m in range(M):
+                            message[m, n] *= feat_cond[r, m]**power
+        elif op == OP_IN:
+            # Propagate latent state inward from children to v.
+            trans = edge_trans[e, int(v > v2), :, :]
+            message *= np.dot(trans, messages[v2, :, :])
+            message_sum = message.sum(axis=0)
+            message /= message_sum
+            logprob += np.log(message_sum)
+        elif op == OP_ROOT:
+            # Aggregate total log probability at the root node.
+            logprob += np.log(message.sum(axis=0))
+            break
+    return logprob
+
+
 class TreeCatServer(ServerBase):
     """Class for serving queries against a trained TreeCat model."""
 
@@ -188,6 +235,13 @@ class TreeCatServer(ServerBase):
         self._config = config
         self._program = make_propagation_program(tree.tree_grid)
 
+        # This annotates each instruction with edge orientation d = int(v > v2)
+        # as python ints, so the python loops in .sample() and .marginals()
+        # need not recompute orientations or unpack numpy scalars.
+        self._oriented_program = [(op, v, v2, e, int(v > v2))
+                                  for op, v, v2, e in self._program.tolist()]
+        self._rng = default_rng(config['seed'])
+
         # These are useful dimensions to import into locals().
         V = self._tree.num_vertices
         E = V - 1  # Number of edges in the tree.
@@ -207,18 +261,31 @@ class TreeCatServer(ServerBase):
         self._edge_probs /= self._edge_probs.sum(axis=(1, 2), keepdims=True)
 
         # This represents information in the pairwise joint posterior minus
-        # information in the individual factors.
-        self._edge_trans = self._edge_probs.copy()
+        # information in the individual factors. Each edge (e, v1, v2) is
+        # stored in both orientations, edge_trans[e, 0, :, :] indexed by
+        # (m1, m2) and a contiguous transpose edge_trans[e, 1, :, :].
+        self._edge_trans = np.empty([E, 2, M, M], np.float32)
         for e, v1, v2 in tree.tree_grid.T:
-            self._edge_trans[e, :, :] /= self._vert_probs[v1, :, np.newaxis]
-            self._edge_trans[e, :, :] /= self._vert_probs[v2, np.newaxis, :]
+            trans = self._edge_trans[e, 0, :, :]
+            trans[...] = self._edge_probs[e, :, :]
+            trans /= self._vert_probs[v1, :, np.newaxis]
+            trans /= self._vert_probs[v2, np.newaxis, :]
+            self._edge_trans[e, 1, :, :] = trans.T
 
         # This is the conditional distribution of features given latent.
         self._feat_cond = suffstats['feat_ss'].astype(np.float32) + feat_prior
-        for v in range(V):
-            beg, end = ragged_index[v:v + 2]
-            feat_block = self._feat_cond[beg:end, :]
-            feat_block /= feat_block.sum(axis=0, keepdims=True)
+        sizes = np.diff(ragged_index)
+        nonempty = sizes > 0  # Empty blocks would confuse reduceat.
+        feat_sums = np.add.reduceat(
+            self._feat_cond, ragged_index[:-1][nonempty], axis=0)
+        self._feat_cond /= np.repeat(feat_sums, sizes[nonempty], axis=0)
+
+        # This allows evidence in an entire ragged block to be propagated at
+        # once, since prod_r cond[r]**data[r] = exp(dot(data, log(cond))).
+        self._feat_logcond = np.log(self._feat_cond)
+
+        # This is scratch space reused by every call to .sample().
+        self._messages_in = np.empty_like(self._vert_probs)
 
         # These are used to inspect and visualize latent structure.
         self._edge_logits = model['edge_logits']
@@ -268,29 +335,31 @@ class TreeCatServer(ServerBase):
         assert counts.dtype == np.int8
         edge_trans = self._edge_trans
         feat_cond = self._feat_cond
+        feat_logcond = self._feat_logcond
+        evidence = data.astype(np.float32)
+        rng = self._rng
 
-        messages_in = self._vert_probs.copy()
-        messages_out = np.tile(self._vert_probs[:, np.newaxis, :], (1, N, 1))
+        messages_in = self._messages_in
+        np.copyto(messages_in, self._vert_probs)
+        messages_out = np.empty([V, N, M], np.float32)  # Written before read.
         vert_samples = np.zeros([V, N], np.int8)
         feat_samples = np.zeros([N, R], np.int8)
         range_N = np.arange(N, dtype=np.int32)
+        choices = np.empty(N, np.intp)  # This is reused by every draw.
 
-        for op, v, v2, e in self._program:
+        for op, v, v2, e, d in self._oriented_program:
             if op == OP_UP:
                 # Propagate upward from observed to latent.
                 message = messages_in[v, :]
                 beg, end = self._ragged_index[v:v + 2]
-                for r in range(beg, end):
-                    # This uses a with-replacement approximation that is exact
-                    # for categorical data but approximate for multinomial.
-                    if data[r]:
-                        message *= feat_cond[r, :]**data[r]
+                # This uses a with-replacement approximation that is exact
+                # for categorical data but approximate for multinomial.
+                message *= np.exp(
+                    np.dot(evidence[beg:end], feat_logcond[beg:end, :]))
             elif op == OP_IN:
                 # Propagate latent state inward from children to v.
                 message = messages_in[v, :]
-                trans = edge_trans[e, :, :]
-                if v > v2:
-                    trans = trans.T
+                trans = edge_trans[e, d, :, :]
                 message *= np.dot(trans, messages_in[v2, :])
                 message /= message.max()  # Scale for numerical stability.
             elif op == OP_ROOT:
@@ -300,22 +369,22 @@ class TreeCatServer(ServerBase):
                 # Propagate latent state outward from parent to v.
                 message = messages_out[v, :, :]
                 message[...] = messages_in[v, np.newaxis, :]
-                trans = edge_trans[e, :, :]
-                if v2 > v:
-                    trans = trans.T
+                trans = edge_trans[e, 1 - d, :, :]
                 message *= trans[vert_samples[v2, :], :]
                 # Scale for numerical stability.
                 message /= message.max(axis=1, keepdims=True)
             elif op == OP_DOWN:
                 # Sample latent and observed assignment.
                 message = messages_out[v, :, :]
-                vert_samples[v, :] = sample_from_probs2(message)
+                vert_samples[v, :] = sample_from_probs2(
+                    message, out=choices, rng=rng)
                 beg, end = self._ragged_index[v:v + 2]
                 feat_block = feat_cond[beg:end, :].T
                 probs = feat_block[vert_samples[v, :], :]
                 samples_block = feat_samples[:, beg:end]
                 for _ in range(counts[v]):
-                    samples_block[range_N, sample_from_probs2(probs)] += 1
+                    sample_from_probs2(probs, out=choices, rng=rng)
+                    samples_block[range_N, choices] += 1
 
         return feat_samples
 
@@ -340,36 +409,13 @@ class TreeCatServer(ServerBase):
         N = data.shape[0]
         assert data.shape == (N, R)
         assert data.dtype == np.int8
-        edge_trans = self._edge_trans
-        feat_cond = self._feat_cond
-
-        messages = np.tile(self._vert_probs[:, :, np.newaxis], (1, 1, N))
-        assert messages.shape == (V, M, N)
-        logprob = np.zeros(N, np.float32)
-
-        for op, v, v2, e in self._program:
-            message = messages[v, :, :]
-            if op == OP_UP:
-                # Propagate upward from observed to latent.
-                beg, end = self._ragged_index[v:v + 2]
-                for r in range(beg, end):
-                    # This uses a with-replacement approximation that is exact
-                    # for categorical data but approximate for multinomial.
-                    power = data[np.newaxis, :, r]
-                    message *= feat_cond[r, :, np.newaxis]**power
-            elif op == OP_IN:
-                # Propagate latent state inward from children to v.
-                trans = edge_trans[e, :, :]
-                if v > v2:
-                    trans = trans.T
-                message *= np.dot(trans, messages[v2, :, :])
-                message_sum = message.sum(axis=0, keepdims=True)
-                message /= message_sum
-                logprob += np.log(message_sum[0, :])
-            elif op == OP_ROOT:
-                # Aggregate total log probability at the root node.
-                logprob += np.log(message.sum(axis=0))
-                return logprob
+        return treecat_logprob(
+            self._program,
+            self._ragged_index,
+            data,
+            self._vert_probs,
+            self._edge_trans,
+            self._feat_cond, )
 
     @profile
     def marginals(self, data):
@@ -390,36 +436,33 @@ class TreeCatServer(ServerBase):
         assert data.dtype == np.int8
         edge_trans = self._edge_trans
         feat_cond = self._feat_cond
+        feat_logcond = self._feat_logcond
+        evidence = data.astype(np.float32)
 
         messages_in = np.empty([V, M, N], dtype=np.float32)
         messages_in[...] = self._vert_probs[:, :, np.newaxis]
         messages_out = np.empty_like(messages_in.copy())
         result = np.zeros([N, R], np.float32)
 
-        for op, v, v2, e in self._program:
+        for op, v, v2, e, d in self._oriented_program:
             message = messages_in[v, :, :]
             if op == OP_UP:
                 # Propagate upward from observed to latent.
                 beg, end = self._ragged_index[v:v + 2]
-                for r in range(beg, end):
-                    # This uses a with-replacement approximation that is exact
-                    # for categorical data but approximate for multinomial.
-                    power = data[np.newaxis, :, r]
-                    message *= feat_cond[r, :, np.newaxis]**power
+                # This uses a with-replacement approximation that is exact
+                # for categorical data but approximate for multinomial.
+                message *= np.exp(
+                    np.dot(feat_logcond[beg:end, :].T, evidence[:, beg:end].T))
                 messages_out[v, :, :] = message
             elif op == OP_IN:
                 # Propagate latent state inward from children to v.
-                trans = edge_trans[e, :, :]
-                if v > v2:
-                    trans = trans.T
+                trans = edge_trans[e, d, :, :]
                 message *= np.dot(trans, messages_in[v2, :, :])
                 # Scale for numerical stability.
                 message /= message.max(axis=0, keepdims=True)
             elif op == OP_OUT:
                 # Propagate latent state outward from parent to v.
-                trans = edge_trans[e, :, :]
-                if v > v2:
-                    trans = trans.T
+                trans = edge_trans[e, d, :, :]
                 from_parent = np.dot(trans, messages_out[v2, :, :])
                 messages_out[v, :, :] *= from_parent
                 message *= from_parent
@@ -524,6 +567,10 @@ class EnsembleServer(ServerBase):
         ServerBase.__init__(self, ensemble[0]['suffstats']['ragged_index'])
         self._ensemble = [TreeCatServer(model) for model in ensemble]
 
+        # Sub-models are seeded seed, seed + 1, ..., so the first unused seed
+        # keeps this generator's stream distinct from the sub-servers'.
+        self._rng = default_rng(ensemble[0]['config']['seed'] + len(ensemble))
+
         # These are used to inspect and visualize latent structure.
         self._edge_logits = self._ensemble[0].edge_logits.copy()
         for server in self._ensemble[1:]:
@@ -551,15 +598,37 @@ class EnsembleServer(ServerBase):
         assert len(samples) == num_samples
         return samples
 
-    def sample(self, N, counts, data=None):
+    def _sample_weights(self, data=None):
+        """Compute posterior probabilities of sub-models given evidence.
+
+        Args:
+            data: An optional single row of conditioning data, as a [R]-shaped
+                ragged numpy array of multinomial counts.
+
+        Returns:
+            A normalized [len(ensemble)]-shaped numpy array of weights,
+            uniform if data is None, else proportional to each sub-model's
+            probability of data, matching the mixture in .logprob().
+        """
         size = len(self._ensemble)
-        pvals = np.ones(size, dtype=np.float32) / size
-        sub_Ns = np.random.multinomial(N, pvals)
+        if data is None:
+            return np.ones(size) / size
+        logprobs = np.array([
+            server.logprob(data[np.newaxis, :])[0]
+            for server in self._ensemble
+        ])
+        weights = np.exp(logprobs - logprobs.max())
+        weights /= weights.sum()
+        return weights
+
+    def sample(self, N, counts, data=None):
+        pvals = self._sample_weights(data)
+        sub_Ns = self._rng.multinomial(N, pvals)
         samples = np.concatenate([
             server.sample(sub_N, counts, data)
             for server, sub_N in zip(self._ensemble, sub_Ns)
         ])
-        np.random.shuffle(samples)
+        self._rng.shuffle(samples)
         assert samples.shape[0] == N
         return samples
 
@@ -731,9 +800,11 @@ class DataServer(object):
         if evidence is None:
             return self._server.logprob(data)
         else:
+            # Propagate joint and evidence rows together in a single batch.
             ragged_evidence = import_rows(self._schema, [evidence])
-            return (self._server.logprob(data + ragged_evidence) -
-                    self._server.logprob(data + evidence))
+            logprobs = self._server.logprob(
+                np.concatenate([data + ragged_evidence, ragged_evidence]))
+            return logprobs[:-1] - logprobs[-1]
 
     def sample(self, N, evidence=None):
         """Draw N samples from the posterior distribution.
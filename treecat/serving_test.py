@@ -3,16 +3,24 @@ from __future__ import division
 from __future__ import print_function
 
 import itertools
+import os
 
 import numpy as np
 import pytest
 from goftests import multinomial_goodness_of_fit
 
+from treecat.format import import_rows
+from treecat.format import load_data
+from treecat.format import load_schema
 from treecat.generate import generate_dataset
 from treecat.generate import generate_fake_ensemble
 from treecat.generate import generate_fake_model
 from treecat.serving import EnsembleServer
 from treecat.serving import TreeCatServer
+from treecat.serving import serve_model
+from treecat.tables import TY_MULTINOMIAL
+from treecat.tables import Table
+from treecat.testutil import TESTDATA
 from treecat.testutil import TINY_CONFIG
 from treecat.testutil import TINY_TABLE
 from treecat.testutil import make_seed
@@ -68,6 +76,59 @@ def test_ensemble_sample_shape(ensemble):
     validate_sample_shape(TINY_TABLE, server)
 
 
+def test_ensemble_sample_weights(ensemble):
+    server = EnsembleServer(ensemble)
+    size = len(ensemble)
+    weights = server._sample_weights()
+    assert np.allclose(weights, 1.0 / size)
+
+    # Conditional weights are the posterior of the uniform mixture in logprob.
+    data = TINY_TABLE.data[:1, :]
+    weights = server._sample_weights(data[0, :])
+    assert weights.shape == (size, )
+    assert np.allclose(weights.sum(), 1.0)
+    logprobs = np.array([sub.logprob(data)[0] for sub in server._ensemble])
+    expected = logprobs - server.logprob(data)[0] - np.log(size)
+    assert np.allclose(np.log(weights), expected, atol=1e-4)
+
+
+def test_server_sample_seed(model):
+    V = TINY_TABLE.num_cols
+    counts = np.ones(V, dtype=np.int8)
+    server1 = TreeCatServer(model)
+    server2 = TreeCatServer(model)
+
+    # Servers draw from their own generators, seeded by config['seed'].
+    set_random_seed(0)
+    samples1 = server1.sample(100, counts)
+    set_random_seed(1)
+    samples2 = server2.sample(100, counts)
+    assert np.all(samples1 == samples2)
+
+    other_model = model.copy()
+    other_model['config'] = model['config'].copy()
+    other_model['config']['seed'] += 1
+    server3 = TreeCatServer(other_model)
+    set_random_seed(0)
+    samples3 = server3.sample(100, counts)
+    assert not np.all(samples1 == samples3)
+
+
+def test_ensemble_sample_seed(ensemble):
+    V = TINY_TABLE.num_cols
+    counts = np.ones(V, dtype=np.int8)
+    data = TINY_TABLE.data[0, :]
+    server1 = EnsembleServer(ensemble)
+    server2 = EnsembleServer(ensemble)
+
+    # Sub-model splits and shuffles also draw from seeded generators.
+    set_random_seed(0)
+    samples1 = server1.sample(100, counts, data)
+    set_random_seed(1)
+    samples2 = server2.sample(100, counts, data)
+    assert np.all(samples1 == samples2)
+
+
 def test_server_logprob_shape(model):
     table = TINY_TABLE
     server = TreeCatServer(model)
@@ -88,6 +149,30 @@ def test_ensemble_logprob_shape(ensemble):
     assert np.isfinite(logprobs).all()
 
 
+def test_data_server_conditional_logprob():
+    schema = load_schema(
+        os.path.join(TESTDATA, 'tiny_types.csv'),
+        os.path.join(TESTDATA, 'tiny_values.csv'),
+        os.path.join(TESTDATA, 'tiny_groups.csv'))
+    data = load_data(schema, os.path.join(TESTDATA, 'tiny_data.csv'))
+    feature_types = [TY_MULTINOMIAL] * len(schema['feature_names'])
+    table = Table(feature_types, schema['ragged_index'], data)
+    model = train_model(table, schema['tree_prior'], TINY_CONFIG)
+    server = serve_model({'schema': schema, 'table': table}, model)
+
+    # Conditional logprob is batched, but must match two separate passes.
+    rows = server.sample(10)
+    evidence = {'genre': 'drama'}
+    actual = server.logprob(rows, evidence)
+    ragged_rows = import_rows(schema, rows)
+    ragged_evidence = import_rows(schema, [evidence])
+    tree_server = TreeCatServer(model)
+    expected = (tree_server.logprob(ragged_rows + ragged_evidence) -
+                tree_server.logprob(ragged_evidence)[0])
+    assert actual.shape == (len(rows), )
+    assert np.allclose(actual, expected)
+
+
 def one_hot(c, C):
     value = np.zeros(C, dtype=np.int8)
     value[c] = 1
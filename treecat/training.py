@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import itertools
 import logging
+import math
 from abc import ABCMeta
 from abc import abstractmethod
 
@@ -34,22 +35,6 @@ from treecat.util import set_random_seed
 logger = logging.getLogger(__name__)
 
 
-def count_pairs(assignments, v1, v2, M):
-    """Construct sufficient statistics for (v1, v2) pairs.
-
-    Args:
-        assignments: An _ x V assignment matrix with values in range(M).
-        v1, v2: Column ids of the assignments matrix.
-        M: The number of possible assignment bins.
-
-    Returns:
-        An M x M array of counts.
-    """
-    assert v1 != v2
-    pairs = assignments[:, v1].astype(np.int32) * M + assignments[:, v2]
-    return np.bincount(pairs, minlength=M * M).reshape((M, M))
-
-
 def logprob_dc(counts, prior, axis=None):
     """Non-normalized log probability of a Dirichlet-Categorical distribution.
 
@@ -60,6 +45,15 @@ def logprob_dc(counts, prior, axis=None):
     return gammaln(np.add(counts, prior, dtype=np.float32)).sum(axis)
 
 
+@jit(nopython=True, cache=True, fastmath=True)
+def lgamma_sum(counts, prior):
+    """Equivalent to logprob_dc(counts, prior), avoiding temporary arrays."""
+    result = 0.0
+    for count in counts.flat:
+        result += math.lgamma(count + prior)
+    return result
+
+
 def make_annealing_schedule(num_rows, epochs, sample_tree_rate):
     """Iterator for subsample annealing, yielding (action, arg) pairs.
 
@@ -151,7 +145,9 @@ class TreeTrainer(object):
         self._tree = TreeStructure(V)
         assert self._tree.num_vertices == V
         self._program = make_propagation_program(self._tree.tree_grid)
-        self._added_rows = set()
+        # Added rows are tracked by a mask, so they can be selected quickly.
+        self._added_rows = np.zeros(N, np.bool_)
+        self._num_added_rows = 0
 
     @abstractmethod
     def add_row(self, row_id):
@@ -173,7 +169,7 @@ class TreeTrainer(object):
         This should only be called after training, i.e. after all rows have
         been added.
         """
-        assert len(self._added_rows) == self._num_rows
+        assert self._num_added_rows == self._num_rows
 
     def get_edges(self):
         """Get a list of the edges in the current tree.
@@ -202,8 +198,8 @@ class TreeTrainer(object):
                 edge_logits: A [K]-shaped numpy array of edge logits.
         """
         logger.info('TreeCatTrainer.sample_tree given %d rows',
-                    len(self._added_rows))
-        SERIES.sample_tree_num_rows.append(len(self._added_rows))
+                    self._num_added_rows)
+        SERIES.sample_tree_num_rows.append(self._num_added_rows)
         complete_grid = self._tree.complete_grid
         edge_logits = self.compute_edge_logits()
         assert edge_logits.shape[0] == complete_grid.shape[1]
@@ -221,7 +217,7 @@ class TreeTrainer(object):
                 edge_logits: A [K]-shaped numpy array of edge logits.
         """
         logger.info('TreeCatTrainer.estimate_tree given %d rows',
-                    len(self._added_rows))
+                    self._num_added_rows)
         complete_grid = self._tree.complete_grid
         edge_logits = self.compute_edge_logits()
         edges = estimate_tree(complete_grid, edge_logits)
@@ -246,7 +242,7 @@ class TreeTrainer(object):
         num_rows = self._num_rows
 
         # Initialize using subsample annealing.
-        assert len(self._added_rows) == 0
+        assert self._num_added_rows == 0
         schedule = make_annealing_schedule(num_rows, init_epochs,
                                            sample_tree_rate)
         for action, row_id in schedule:
@@ -261,7 +257,7 @@ class TreeTrainer(object):
                 raise ValueError(action)
 
         # Run full gibbs scans.
-        assert len(self._added_rows) == num_rows
+        assert self._num_added_rows == num_rows
         for step in range(full_epochs):
             edges, edge_logits = self.sample_tree()
             self.set_edges(edges)
@@ -270,7 +266,7 @@ class TreeTrainer(object):
                 self.add_row(row_id)
 
         # Compute optimal tree.
-        assert len(self._added_rows) == num_rows
+        assert self._num_added_rows == num_rows
         edges, edge_logits = self.estimate_tree()
         if self._config['learning_estimate_tree']:
             self.set_edges(edges)
@@ -284,6 +280,10 @@ class TreeTrainer(object):
         }
 
 
+# Above this count, treecat_add_cell switches from products to lgamma.
+POLYA_PRODUCT_MAX_COUNT = 8
+
+
 @jit(nopython=True, cache=True)
 def treecat_add_cell(
         feature_type,
@@ -298,17 +298,127 @@ def treecat_add_cell(
         feat_block = feat_probs[beg:end, :]
         meas_block = meas_probs[v, :]
         for c, count in enumerate(data_row[beg:end]):
-            for _ in range(count):
-                message *= feat_block[c, :]
-                message /= meas_block
-                feat_block[c, :] += np.float32(1)
-                meas_block += np.float32(1)
+            if count == 0:
+                continue
+            # Apply count sequential Polya urn updates in a single pass, as a
+            # ratio of rising factorials. Small counts accumulate numerator and
+            # denominator products and divide once; large counts use lgamma.
+            for m in range(message.shape[0]):
+                feat = feat_block[c, m]
+                meas = meas_block[m]
+                if count <= POLYA_PRODUCT_MAX_COUNT:
+                    num = 1.0
+                    den = 1.0
+                    for i in range(count):
+                        num *= feat + i
+                        den *= meas + i
+                    message[m] *= num / den
+                else:
+                    message[m] *= math.exp(
+                        math.lgamma(feat + count) - math.lgamma(feat) -
+                        math.lgamma(meas + count) + math.lgamma(meas))
+            feat_block[c, :] += count
+            meas_block += count
     else:
         raise NotImplementedError
 
 
+@jit(nopython=True, cache=True, fastmath=True)
+def treecat_propagate_in(
+        trans,
+        transpose,
+        child_message,
+        child_probs,
+        probs,
+        message,
+        scratch, ):
+    """Fused inward message update from a child to its parent.
+
+    This computes the equivalent of
+
+      message *= np.dot(trans, child_message / child_probs) / probs
+      message /= message.max()
+
+    in a few passes over M, without allocating temporaries. The product is
+    taken against trans.T if transpose is true. scratch is an [2, M]-shaped
+    work array.
+    """
+    M = message.shape[0]
+    ratio = scratch[0, :]
+    total = scratch[1, :]
+    for j in range(M):
+        ratio[j] = child_message[j] / child_probs[j]
+    if transpose:
+        # Accumulate by rows so that trans is read contiguously.
+        total[:] = 0
+        for j in range(M):
+            for i in range(M):
+                total[i] += trans[j, i] * ratio[j]
+    else:
+        for i in range(M):
+            dot = np.float32(0)
+            for j in range(M):
+                dot += trans[i, j] * ratio[j]
+            total[i] = dot
+    scale = np.float32(0)
+    for i in range(M):
+        message[i] *= total[i] / probs[i]
+        scale = max(scale, message[i])
+    for i in range(M):
+        message[i] /= scale  # Scale for numerical stability.
+
+
+@jit(nopython=True, cache=True, nogil=True)
+def treecat_update_suffstats(
+        diff,
+        feature_types,
+        ragged_index,
+        data_row,
+        tree_grid,
+        assignments,
+        vert_ss,
+        edge_ss,
+        feat_ss,
+        meas_ss,
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs,
+        feat_prior,
+        meas_prior,
+        vert_logits,
+        vert_gammaln_table, ):
+    # This adds (diff = 1) or removes (diff = -1) one row in a single pass,
+    # keeping probs = ss + prior and vert_logits in sync with vert_ss.
+    for v, m in enumerate(assignments):
+        count = vert_ss[v, m]
+        vert_logits[v] += (vert_gammaln_table[count + diff] -
+                           vert_gammaln_table[count])
+        vert_ss[v, m] = count + diff
+        vert_probs[v, m] += diff
+        feature_type = feature_types[v]
+        if feature_type == TY_MULTINOMIAL:
+            beg, end = ragged_index[v:v + 2]
+            total = 0
+            for r in range(beg, end):
+                count = data_row[r]
+                if count:
+                    feat_ss[r, m] += diff * count
+                    feat_probs[r, m] = feat_ss[r, m] + feat_prior
+                    total += count
+            meas_ss[v, m] += diff * total
+            meas_probs[v, m] = meas_ss[v, m] + meas_prior[v, 0]
+        else:
+            raise NotImplementedError
+    for e in range(tree_grid.shape[1]):
+        m1 = assignments[tree_grid[1, e]]
+        m2 = assignments[tree_grid[2, e]]
+        edge_ss[e, m1, m2] += diff
+        edge_probs[e, m1, m2] += diff
+
+
 @profile
-@jit(nopython=True, cache=True)
+@jit(nopython=True, cache=True, nogil=True)
 def treecat_add_row(
         feature_types,
         ragged_index,
@@ -323,9 +433,14 @@ def treecat_add_row(
         vert_probs,
         edge_probs,
         feat_probs,
-        meas_probs, ):
+        meas_probs,
+        feat_prior,
+        meas_prior,
+        vert_logits,
+        vert_gammaln_table, ):
     # Sample latent assignments using dynamic programming.
     messages = vert_probs.copy()
+    scratch = np.empty((2, messages.shape[1]), np.float32)
     for i in range(len(program)):
         op, v, v2, e = program[i]
         message = messages[v, :]
@@ -341,44 +456,57 @@ def treecat_add_row(
                 v, )
         elif op == OP_IN:
             # Propagate latent state inward from children to v.
-            trans = edge_probs[e, :, :]
-            if v > v2:
-                trans = trans.T
-            message *= np.dot(trans, messages[v2, :] / vert_probs[v2, :])
-            message /= vert_probs[v, :]
-            message /= message.max()  # Scale for numerical stability.
+            treecat_propagate_in(
+                edge_probs[e, :, :],
+                v > v2,
+                messages[v2, :],
+                vert_probs[v2, :],
+                vert_probs[v, :],
+                message,
+                scratch, )
         elif op == OP_ROOT:
             # Process root node.
             assignments[v] = sample_from_probs(message)
         elif op == OP_OUT:
             # Propagate latent state outward from parent to v.
-            trans = edge_probs[e, :, :]
-            if v2 > v:
-                trans = trans.T
-            message *= trans[assignments[v2], :]
+            if v2 < v:
+                message *= edge_probs[e, assignments[v2], :]
+            else:
+                message *= edge_probs[e, :, assignments[v2]]
             message /= vert_probs[v, :]
             assignments[v] = sample_from_probs(message)
 
-    # Update sufficient statistics.
-    for v, m in enumerate(assignments):
-        vert_ss[v, m] += 1
-    for e in range(tree_grid.shape[1]):
-        m1 = assignments[tree_grid[1, e]]
-        m2 = assignments[tree_grid[2, e]]
-        edge_ss[e, m1, m2] += 1
-        edge_probs[e, m1, m2] += 1
-    for v, m in enumerate(assignments):
-        feature_type = feature_types[v]
-        if feature_type == TY_MULTINOMIAL:
-            beg, end = ragged_index[v:v + 2]
-            feat_ss[beg:end, m] += data_row[beg:end]
-            meas_ss[v, m] += data_row[beg:end].sum()
-        else:
-            raise NotImplementedError
+    # Restore cells used as scratch space by treecat_add_cell.
+    for v in range(len(assignments)):
+        beg, end = ragged_index[v:v + 2]
+        for r in range(beg, end):
+            if data_row[r]:
+                feat_probs[r, :] = feat_ss[r, :] + feat_prior
+        meas_probs[v, :] = meas_ss[v, :] + meas_prior[v, 0]
+
+    treecat_update_suffstats(
+        1,
+        feature_types,
+        ragged_index,
+        data_row,
+        tree_grid,
+        assignments,
+        vert_ss,
+        edge_ss,
+        feat_ss,
+        meas_ss,
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs,
+        feat_prior,
+        meas_prior,
+        vert_logits,
+        vert_gammaln_table, )
 
 
 @profile
-@jit(nopython=True, cache=True)
+@jit(nopython=True, cache=True, nogil=True)
 def treecat_remove_row(
         feature_types,
         ragged_index,
@@ -389,23 +517,45 @@ def treecat_remove_row(
         edge_ss,
         feat_ss,
         meas_ss,
-        edge_probs, ):
-    # Update sufficient statistics.
-    for v, m in enumerate(assignments):
-        vert_ss[v, m] -= 1
-    for e in range(tree_grid.shape[1]):
-        m1 = assignments[tree_grid[1, e]]
-        m2 = assignments[tree_grid[2, e]]
-        edge_ss[e, m1, m2] -= 1
-        edge_probs[e, m1, m2] -= 1
-    for v, m in enumerate(assignments):
-        feature_type = feature_types[v]
-        if feature_type == TY_MULTINOMIAL:
-            beg, end = ragged_index[v:v + 2]
-            feat_ss[beg:end, m] -= data_row[beg:end]
-            meas_ss[v, m] -= data_row[beg:end].sum()
-        else:
-            raise NotImplementedError
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs,
+        feat_prior,
+        meas_prior,
+        vert_logits,
+        vert_gammaln_table, ):
+    treecat_update_suffstats(
+        -1,
+        feature_types,
+        ragged_index,
+        data_row,
+        tree_grid,
+        assignments,
+        vert_ss,
+        edge_ss,
+        feat_ss,
+        meas_ss,
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs,
+        feat_prior,
+        meas_prior,
+        vert_logits,
+        vert_gammaln_table, )
+
+
+@profile
+@jit(nopython=True, cache=True)
+def treecat_compute_edge_ss(tree_grid, assignments, edge_ss):
+    # This makes a single pass over rows, counting pairs for all edges.
+    edge_ss[:, :, :] = 0
+    for n in range(assignments.shape[0]):
+        for e in range(tree_grid.shape[1]):
+            m1 = assignments[n, tree_grid[1, e]]
+            m2 = assignments[n, tree_grid[2, e]]
+            edge_ss[e, m1, m2] += 1
 
 
 @jit(nopython=True, cache=True)
@@ -420,7 +570,7 @@ def treecat_compute_edge_logit(M, gammaln_table, assign1, assign2):
     return result
 
 
-@jit(nopython=True, parallel=True)
+@jit(nopython=True, parallel=True, cache=True)
 def treecat_compute_edge_logits_par(M, grid, gammaln_table, assignments,
                                     vert_logits):
     K = grid.shape[1]
@@ -482,7 +632,7 @@ class TreeCatTrainer(TreeTrainer):
         V = table.num_cols  # Number of features, i.e. vertices.
         TreeTrainer.__init__(self, N, V, tree_prior, config)
         assert self._num_rows == N
-        assert len(self._added_rows) == 0
+        assert self._num_added_rows == 0
         self._table = table
         self._assignments = np.zeros([N, V], dtype=np.int8)
 
@@ -504,6 +654,8 @@ class TreeCatTrainer(TreeTrainer):
         self._gammaln_table = gammaln(
             np.arange(1 + N, dtype=np.float32) + self._edge_prior)
         assert self._gammaln_table.dtype == np.float32
+        self._vert_gammaln_table = gammaln(
+            np.arange(1 + N, dtype=np.float64) + self._vert_prior)
 
         # Sufficient statistics are maintained always.
         self._vert_ss = np.zeros([V, M], np.int32)
@@ -511,25 +663,25 @@ class TreeCatTrainer(TreeTrainer):
         self._feat_ss = np.zeros([table.ragged_index[-1], M], np.int32)
         self._meas_ss = np.zeros([V, M], np.int32)
 
-        # Temporaries.
+        # These are maintained incrementally along with sufficient statistics.
         self._vert_probs = np.empty(self._vert_ss.shape, np.float32)
         self._edge_probs = np.empty(self._edge_ss.shape, np.float32)
         self._feat_probs = np.empty(self._feat_ss.shape, np.float32)
         self._meas_probs = np.empty(self._meas_ss.shape, np.float32)
-
-        # Maintain edge_probs.
+        np.add(self._vert_ss, self._vert_prior, out=self._vert_probs)
         np.add(self._edge_ss, self._edge_prior, out=self._edge_probs)
+        np.add(self._feat_ss, self._feat_prior, out=self._feat_probs)
+        np.add(self._meas_ss, self._meas_prior, out=self._meas_probs)
+
+        # This is maintained incrementally in float64 to avoid drift.
+        self._vert_logits = self._vert_gammaln_table[self._vert_ss].sum(1)
 
     @profile
     def add_row(self, row_id):
         logger.debug('TreeCatTrainer.add_row %d', row_id)
-        assert row_id not in self._added_rows, row_id
-        self._added_rows.add(row_id)
-
-        # These are used for scratch work, so we create them each step.
-        np.add(self._vert_ss, self._vert_prior, out=self._vert_probs)
-        np.add(self._feat_ss, self._feat_prior, out=self._feat_probs)
-        np.add(self._meas_ss, self._meas_prior, out=self._meas_probs)
+        assert not self._added_rows[row_id], row_id
+        self._added_rows[row_id] = True
+        self._num_added_rows += 1
 
         treecat_add_row(
             self._table.feature_types,
@@ -545,13 +697,18 @@ class TreeCatTrainer(TreeTrainer):
             self._vert_probs,
             self._edge_probs,
             self._feat_probs,
-            self._meas_probs, )
+            self._meas_probs,
+            self._feat_prior,
+            self._meas_prior,
+            self._vert_logits,
+            self._vert_gammaln_table, )
 
     @profile
     def remove_row(self, row_id):
         logger.debug('TreeCatTrainer.remove_row %d', row_id)
-        assert row_id in self._added_rows, row_id
-        self._added_rows.remove(row_id)
+        assert self._added_rows[row_id], row_id
+        self._added_rows[row_id] = False
+        self._num_added_rows -= 1
 
         treecat_remove_row(
             self._table.feature_types,
@@ -563,14 +720,20 @@ class TreeCatTrainer(TreeTrainer):
             self._edge_ss,
             self._feat_ss,
             self._meas_ss,
-            self._edge_probs, )
+            self._vert_probs,
+            self._edge_probs,
+            self._feat_probs,
+            self._meas_probs,
+            self._feat_prior,
+            self._meas_prior,
+            self._vert_logits,
+            self._vert_gammaln_table, )
 
     def set_edges(self, edges):
         TreeTrainer.set_edges(self, edges)
-        V, E, K, M = self._VEKM
-        assignments = self._assignments[sorted(self._added_rows), :]
-        for e, v1, v2 in self._tree.tree_grid.T:
-            self._edge_ss[e, :, :] = count_pairs(assignments, v1, v2, M)
+        assignments = self._assignments[self._added_rows, :]
+        treecat_compute_edge_ss(self._tree.tree_grid, assignments,
+                                self._edge_ss)
         np.add(self._edge_ss, self._edge_prior, out=self._edge_probs)
 
     @profile
@@ -580,11 +743,11 @@ class TreeCatTrainer(TreeTrainer):
         This is used for sampling and estimating the latent tree.
         """
         V, E, K, M = self._VEKM
-        vert_logits = logprob_dc(self._vert_ss, self._vert_prior, axis=1)
-        if len(self._added_rows) == V:
+        vert_logits = self._vert_logits.astype(np.float32)
+        if self._num_added_rows == self._num_rows:
             assignments = self._assignments
         else:
-            assignments = self._assignments[sorted(self._added_rows), :]
+            assignments = self._assignments[self._added_rows, :]
         assignments = np.array(assignments, order='F')
         parallel = self._config['learning_parallel']
         result = treecat_compute_edge_logits(M, self._tree.complete_grid,
@@ -598,17 +761,17 @@ class TreeCatTrainer(TreeTrainer):
 
         This is used for testing goodness of fit of the latent state kernel.
         """
-        assert len(self._added_rows) == self._num_rows
+        assert self._num_added_rows == self._num_rows
         V, E, K, M = self._VEKM
-        vertex_logits = logprob_dc(self._vert_ss, self._vert_prior, axis=1)
+        vertex_logits = self._vert_logits
         logprob = vertex_logits.sum()
         for e, v1, v2 in self._tree.tree_grid.T:
-            logprob += (logprob_dc(self._edge_ss[e, :, :], self._edge_prior) -
+            logprob += (lgamma_sum(self._edge_ss[e, :, :], self._edge_prior) -
                         vertex_logits[v1] - vertex_logits[v2])
         for v in range(V):
             beg, end = self._table.ragged_index[v:v + 2]
-            logprob += logprob_dc(self._feat_ss[beg:end, :], self._feat_prior)
-            logprob -= logprob_dc(self._meas_ss[v, :], self._meas_prior[v])
+            logprob += lgamma_sum(self._feat_ss[beg:end, :], self._feat_prior)
+            logprob -= lgamma_sum(self._meas_ss[v, :], self._meas_prior[v, 0])
         return logprob
 
     def train(self):
@@ -721,8 +884,9 @@ class TreeGaussTrainer(TreeTrainer):
 
     def add_row(self, row_id):
         logger.debug('TreeGaussTrainer.add_row %d', row_id)
-        assert row_id not in self._added_rows, row_id
-        self._added_rows.add(row_id)
+        assert not self._added_rows[row_id], row_id
+        self._added_rows[row_id] = True
+        self._num_added_rows += 1
 
         treegauss_add_row(
             self._data[row_id, :],
@@ -735,8 +899,9 @@ class TreeGaussTrainer(TreeTrainer):
 
     def remove_row(self, row_id):
         logger.debug('TreeGaussTrainer.remove_row %d', row_id)
-        assert row_id in self._added_rows, row_id
-        self._added_rows.remove(row_id)
+        assert self._added_rows[row_id], row_id
+        self._added_rows[row_id] = False
+        self._num_added_rows -= 1
 
         treecat_remove_row(
             self._data[row_id, :],
@@ -748,7 +913,7 @@ class TreeGaussTrainer(TreeTrainer):
 
     def set_edges(self, edges):
         TreeTrainer.set_edges(self, edges)
-        latent = self._latent[sorted(self._added_rows), :, :]
+        latent = self._latent[self._added_rows, :, :]
         for e, v1, v2 in self._tree.tree_grid.T:
             self._edge_ss[e, :, :] = np.dot(latent[:, v1, :].T,
                                             latent[:, v2, :])
@@ -765,7 +930,7 @@ class TreeGaussTrainer(TreeTrainer):
 
         This is used for testing goodness of fit of the latent state kernel.
         """
-        assert len(self._added_rows) == self._num_rows
+        assert self._num_added_rows == self._num_rows
         TODO('https://github.com/posterior/treecat/issues/26')
 
     def train(self):
@@ -812,7 +977,7 @@ class TreeMogTrainer(TreeTrainer):
 
     def logprob(self):
         """Compute non-normalized log probability of data and latent state."""
-        assert len(self._added_rows) == self._num_rows
+        assert self._num_added_rows == self._num_rows
         TODO('https://github.com/posterior/treecat/issues/27')
 
 
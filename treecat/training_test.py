@@ -14,11 +14,17 @@ from treecat.structure import TreeStructure
 from treecat.structure import estimate_tree
 from treecat.structure import print_tree
 from treecat.structure import triangular_to_square
+from treecat.tables import TY_MULTINOMIAL
 from treecat.testutil import numpy_seterr
 from treecat.training import TreeCatTrainer
+from treecat.training import lgamma_sum
+from treecat.training import logprob_dc
 from treecat.training import make_annealing_schedule
 from treecat.training import train_ensemble
 from treecat.training import train_model
+from treecat.training import treecat_add_cell
+from treecat.training import treecat_compute_edge_ss
+from treecat.training import treecat_propagate_in
 from treecat.util import np_printoptions
 from treecat.util import set_random_seed
 
@@ -46,6 +52,93 @@ def test_make_annealing_schedule():
     assert assigned_rows == num_rows
 
 
+@pytest.mark.parametrize('shape', [(1, ), (5, ), (3, 4), (7, 7)])
+@pytest.mark.parametrize('prior', [0.1, 0.5])
+def test_lgamma_sum(shape, prior):
+    counts = np.random.randint(10, size=shape).astype(np.int32)
+    expected = logprob_dc(counts, prior)
+    actual = lgamma_sum(counts, prior)
+    assert np.allclose(actual, expected, rtol=1e-5)
+
+
+def count_pairs(assignments, v1, v2, M):
+    """Construct sufficient statistics for (v1, v2) pairs.
+
+    Args:
+        assignments: An _ x V assignment matrix with values in range(M).
+        v1, v2: Column ids of the assignments matrix.
+        M: The number of possible assignment bins.
+
+    Returns:
+        An M x M array of counts.
+    """
+    assert v1 != v2
+    pairs = assignments[:, v1].astype(np.int32) * M + assignments[:, v2]
+    return np.bincount(pairs, minlength=M * M).reshape((M, M))
+
+
+@pytest.mark.parametrize('N,V,M', [
+    (0, 2, 2),
+    (1, 2, 2),
+    (10, 3, 3),
+    (20, 5, 4),
+])
+def test_treecat_compute_edge_ss(N, V, M):
+    tree = generate_tree(num_cols=V)
+    grid = tree.tree_grid
+    E = V - 1
+    assignments = np.random.randint(M, size=[N, V]).astype(np.int8)
+    edge_ss = np.ones([E, M, M], np.int32)
+    treecat_compute_edge_ss(grid, assignments, edge_ss)
+    for e, v1, v2 in grid.T:
+        expected = count_pairs(assignments, v1, v2, M)
+        assert np.all(edge_ss[e, :, :] == expected)
+
+
+@pytest.mark.parametrize('count', [0, 1, 3, 8, 9, 50, 127])
+def test_treecat_add_cell(count):
+    M = 7
+    ragged_index = np.array([0, 2, 5], np.int32)
+    data_row = np.zeros(5, np.int8)
+    data_row[3] = count
+    message = np.random.random(M).astype(np.float32)
+    feat_probs = 0.5 + np.random.random([5, M]).astype(np.float32)
+    meas_probs = 3.0 + np.random.random([2, M]).astype(np.float32)
+
+    # Compare against count sequential Polya urn updates.
+    expected = message.astype(np.float64)
+    for i in range(count):
+        expected *= (feat_probs[3, :] + i) / (meas_probs[1, :] + i)
+    expected_feat = feat_probs.copy()
+    expected_feat[3, :] += count
+    expected_meas = meas_probs.copy()
+    expected_meas[1, :] += count
+    treecat_add_cell(TY_MULTINOMIAL, ragged_index, data_row, message,
+                     feat_probs, meas_probs, 1)
+    assert np.allclose(message, expected, rtol=1e-4)
+    assert np.all(feat_probs == expected_feat)
+    assert np.all(meas_probs == expected_meas)
+
+
+@pytest.mark.parametrize('transpose', [False, True])
+@pytest.mark.parametrize('M', [1, 2, 7, 32])
+def test_treecat_propagate_in(M, transpose):
+    trans = np.random.random([M, M]).astype(np.float32)
+    child_message = np.random.random(M).astype(np.float32)
+    child_probs = 0.1 + np.random.random(M).astype(np.float32)
+    probs = 0.1 + np.random.random(M).astype(np.float32)
+    message = np.random.random(M).astype(np.float32)
+    scratch = np.empty([2, M], np.float32)
+
+    expected = message.copy()
+    expected *= np.dot(trans.T if transpose else trans,
+                       child_message / child_probs) / probs
+    expected /= expected.max()
+    treecat_propagate_in(trans, transpose, child_message, child_probs, probs,
+                         message, scratch)
+    assert np.allclose(message, expected, rtol=1e-5)
+
+
 def validate_model(table, model, config):
     ragged_index = table.ragged_index
     data = table.data
@@ -162,6 +255,39 @@ def test_train_ensemble(N, V, C, M):
         validate_model(table, model, sub_config)
 
 
+@pytest.mark.parametrize('N,V,C,M', [
+    (1, 1, 1, 1),
+    (2, 2, 2, 2),
+    (3, 3, 3, 3),
+    (4, 4, 4, 4),
+    (5, 5, 5, 5),
+])
+def test_trainer_incremental_state(N, V, C, M):
+    config = make_config(model_num_clusters=M)
+    K = V * (V - 1) // 2
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    table = dataset['table']
+    tree_prior = np.exp(np.random.random(K), dtype=np.float32)
+    trainer = TreeCatTrainer(table, tree_prior, config)
+    for row_id in range(N):
+        trainer.add_row(row_id)
+    for row_id in range(N):
+        trainer.remove_row(row_id)
+        trainer.add_row(row_id)
+    trainer.remove_row(0)
+
+    assert np.allclose(trainer._vert_probs,
+                       trainer._vert_ss + trainer._vert_prior)
+    assert np.allclose(trainer._edge_probs,
+                       trainer._edge_ss + trainer._edge_prior)
+    assert np.allclose(trainer._feat_probs,
+                       trainer._feat_ss + trainer._feat_prior)
+    assert np.allclose(trainer._meas_probs,
+                       trainer._meas_ss + trainer._meas_prior)
+    assert np.allclose(trainer._vert_logits,
+                       logprob_dc(trainer._vert_ss, trainer._vert_prior, 1))
+
+
 def hash_assignments(assignments):
     assert isinstance(assignments, np.ndarray)
     return tuple(tuple(row) for row in assignments)
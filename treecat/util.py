@@ -53,6 +53,11 @@ if TREECAT_JIT:
         warn('numba.jit not available')
 assert prange  # Pacify flake8.
 
+try:
+    from numpy.random import default_rng
+except ImportError:
+    default_rng = np.random.RandomState  # Legacy numpy < 1.17.
+
 
 @jit(nopython=True, cache=True)
 def jit_random_seed(seed):
@@ -88,12 +93,14 @@ def sample_from_probs(probs):
     return (np.random.rand() * cdf[-1] < cdf).argmax()
 
 
-def sample_from_probs2(probs, out=None):
+def sample_from_probs2(probs, out=None, rng=np.random):
     """Sample from multiple vectors of non-normalized probabilities.
 
     Args:
         probs: An [N, M]-shaped numpy array of non-normalized probabilities.
         out: An optional destination for the result.
+        rng: An optional random number generator, as returned by
+            default_rng(). Defaults to numpy's global random state.
 
     Returns:
         An [N]-shaped numpy array of integers in range(M).
@@ -101,7 +108,7 @@ def sample_from_probs2(probs, out=None):
     # Adapted from https://stackoverflow.com/questions/40474436
     assert len(probs.shape) == 2
     cdf = probs.cumsum(axis=1)
-    u = np.random.rand(probs.shape[0], 1) * cdf[:, -1, np.newaxis]
+    u = rng.uniform(size=(probs.shape[0], 1)) * cdf[:, -1, np.newaxis]
     return (u < cdf).argmax(axis=1, out=out)
 
 